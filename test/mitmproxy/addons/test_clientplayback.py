@@ -1,9 +1,13 @@
 import asyncio
+import copy
+import itertools
+import socket
 import ssl
 from contextlib import asynccontextmanager
 
 import pytest
 
+from ...conftest import EagerTaskCreationEventLoopPolicy
 from mitmproxy.addons.clientplayback import ClientPlayback
 from mitmproxy.addons.clientplayback import ReplayHandler
 from mitmproxy.addons.proxyserver import Proxyserver
@@ -13,6 +17,57 @@ from mitmproxy.exceptions import CommandError
 from mitmproxy.exceptions import OptionsError
 from mitmproxy.test import taddons
 from mitmproxy.test import tflow
+from mitmproxy.utils import data
+
+# With `pytest -n auto --dist loadgroup`, keep this module on a single xdist worker
+# so that the module-scoped loop and fixtures below are only set up once.
+pytestmark = pytest.mark.xdist_group("clientplayback")
+
+# Async tests in this module share one event loop, see event_loop_policy below.
+module_loop = pytest.mark.asyncio(scope="module")
+
+here = data.Data(__name__)
+
+# A single-flow dump. test_load and test_configure both read it for real, as each covers a different loading path.
+DUMPFILE = here.path("../data/dumpfile-018.mitm")
+
+
+@pytest.fixture(scope="module")
+def event_loop_policy():
+    """Module-scoped override of the global fixture so that the loop is only set up once."""
+    return EagerTaskCreationEventLoopPolicy()
+
+
+async def _run_handler(handle_conn, reader, writer) -> None:
+    try:
+        await handle_conn(reader, writer)
+    except Exception as e:
+        print(f"!!! TCP handler failed: {e}")
+        # Skip the orderly shutdown, which would flush buffers and possibly wait on the peer.
+        writer.transport.abort()
+        raise
+    except asyncio.CancelledError:
+        writer.transport.abort()
+        raise
+    finally:
+        if not writer.is_closing():
+            writer.close()
+        await writer.wait_closed()
+
+
+async def _join_handlers(tasks: list[asyncio.Task], cancel: bool = False) -> None:
+    """
+    Wait for all handler tasks to finish and re-raise the first failure, if any.
+    With `cancel`, handlers are cancelled first so that a failing test does not wait on them forever.
+    """
+    if cancel:
+        for t in tasks:
+            t.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, BaseException) and not (
+            cancel and isinstance(result, asyncio.CancelledError)
+        ):
+            raise result
 
 
 @asynccontextmanager
@@ -23,136 +78,303 @@ async def tcp_server(handle_conn, **server_args) -> Address:
     2. Ensures that all handlers are closed properly. If we don't do that,
        we get ghost errors in others tests from StreamWriter.__del__.
 
-    Spawning a TCP server is relatively slow. Consider using in-memory networking for faster tests.
+    Spawning a TCP server is relatively slow. Consider using `memory_server` for faster tests.
     """
-    if not hasattr(asyncio, "TaskGroup"):
-        pytest.skip("Skipped because asyncio.TaskGroup is unavailable.")
-
-    tasks = asyncio.TaskGroup()
+    tasks: list[asyncio.Task] = []
 
-    async def handle_conn_wrapper(
-        reader: asyncio.StreamReader,
-        writer: asyncio.StreamWriter,
-    ) -> None:
-        try:
-            await handle_conn(reader, writer)
-        except Exception as e:
-            print(f"!!! TCP handler failed: {e}")
-            raise
-        finally:
-            if not writer.is_closing():
-                writer.close()
-            await writer.wait_closed()
-
-    async def _handle(r, w):
-        tasks.create_task(handle_conn_wrapper(r, w))
+    def _handle(r, w):
+        tasks.append(asyncio.create_task(_run_handler(handle_conn, r, w)))
 
     server = await asyncio.start_server(_handle, "127.0.0.1", 0, **server_args)
     await server.start_serving()
     async with server:
-        async with tasks:
+        try:
             yield server.sockets[0].getsockname()
+        except BaseException:
+            await _join_handlers(tasks, cancel=True)
+            raise
+        await _join_handlers(tasks)
 
 
-@pytest.mark.parametrize("mode", ["http", "https", "upstream", "err"])
-@pytest.mark.parametrize("concurrency", [-1, 1])
-async def test_playback(tdata, mode, concurrency):
-    async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        if mode == "err":
-            return
-        req = await reader.readline()
-        if mode == "upstream":
-            assert req == b"GET http://address:22/path HTTP/1.1\r\n"
-        else:
-            assert req == b"GET /path HTTP/1.1\r\n"
-        req = await reader.readuntil(b"data")
-        assert req == (
-            b"header: qvalue\r\n"
-            b"content-length: 4\r\nHost: example.mitmproxy.org\r\n\r\n"
-            b"data"
+class _MemoryStreamWriter(asyncio.StreamWriter):
+    """A StreamWriter that reports a fake peer address, as socketpair() sockets have none."""
+
+    def __init__(self, *args, peername: Address) -> None:
+        super().__init__(*args)
+        self._peername = peername
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self._peername
+        return super().get_extra_info(name, default)
+
+
+class MemoryServer:
+    """
+    An in-memory stand-in for `tcp_server`.
+
+    Instead of listening on a TCP port, every call to `connect` creates a connected
+    `socket.socketpair()`, hands one end to `handle_conn` and returns the other one as
+    a `(reader, writer)` pair. `connect` is a drop-in replacement for `asyncio.open_connection`,
+    so tests can monkeypatch the latter to route mitmproxy's server connections here.
+
+    This bypasses how mitmproxy actually dials upstream (e.g. `local_addr` and the socket's addresses),
+    so tests for that need `tcp_server`. Note that on Windows, `socket.socketpair()` is emulated
+    over a loopback TCP connection.
+    """
+
+    address: Address = ("192.0.2.1", 80)
+    """The address clients are expected to dial. Nothing ever listens on it."""
+
+    tasks: list[asyncio.Task]
+    """The server-side handler tasks spawned so far."""
+
+    def __init__(self, handle_conn, **server_args) -> None:
+        self.handle_conn = handle_conn
+        self.server_args = server_args
+        self.tasks = []
+
+    async def connect(self, host, port, *, local_addr=None):
+        assert (host, port) == self.address
+        assert local_addr is None, "Binding to a local address is not supported."
+        loop = asyncio.get_running_loop()
+        client_sock, server_sock = socket.socketpair()
+        # The server side needs to run concurrently so that a TLS handshake can complete.
+        self.tasks.append(asyncio.create_task(self._serve(server_sock)))
+
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.create_connection(lambda: protocol, sock=client_sock)
+        writer = _MemoryStreamWriter(
+            transport, protocol, reader, loop, peername=self.address
+        )
+        return reader, writer
+
+    async def _serve(self, sock: socket.socket) -> None:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.connect_accepted_socket(
+            lambda: protocol, sock, **self.server_args
+        )
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        await _run_handler(self.handle_conn, reader, writer)
+
+
+@asynccontextmanager
+async def memory_server(handle_conn, **server_args) -> MemoryServer:
+    """Like `tcp_server`, but without any listen()/accept() or TCP handshakes, see `MemoryServer`."""
+    srv = MemoryServer(handle_conn, **server_args)
+    try:
+        yield srv
+    except BaseException:
+        await _join_handlers(srv.tasks, cancel=True)
+        raise
+    await _join_handlers(srv.tasks)
+
+
+def replay_tasks_done(cp: ClientPlayback) -> asyncio.Event:
+    """Return an event that is set once all of `cp`'s concurrent replay tasks have finished."""
+    done = asyncio.Event()
+
+    def _check(_=None) -> None:
+        if not cp.replay_tasks:
+            done.set()
+
+    # ClientPlayback's own done callback (which removes the task) was registered first, so it runs first.
+    for t in cp.replay_tasks:
+        t.add_done_callback(_check)
+    _check()
+    return done
+
+
+async def wait_for_replay_tasks(cp: ClientPlayback, timeout: float = 2) -> None:
+    """Wait on `replay_tasks_done`, failing with the number of in-flight replays after `timeout` seconds."""
+    try:
+        await asyncio.wait_for(replay_tasks_done(cp).wait(), timeout)
+    except asyncio.TimeoutError:
+        pytest.fail(f"{len(cp.replay_tasks)} replays still in flight after {timeout}s.")
+
+
+async def join_replay_queue(cp: ClientPlayback, timeout: float = 2) -> None:
+    """
+    Wait until `cp` has processed its queue. Unlike a plain `asyncio.wait_for`, this fails
+    with the playback state attached so that hangs are easier to diagnose.
+    """
+    join = asyncio.ensure_future(cp.queue.join())
+    done, _ = await asyncio.wait([join], timeout=timeout)
+    if not done:
+        join.cancel()
+        pytest.fail(
+            f"Replay queue not processed after {timeout}s: "
+            f"{cp.count()} flows left, {len(cp.replay_tasks)} replays in flight."
+        )
+
+
+@pytest.fixture(scope="module")
+def server_ssl_context() -> ssl.SSLContext:
+    """The upstream server's TLS context, loaded once as parsing the cert chain is comparatively slow."""
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(
+        certfile=here.path("../net/data/verificationcerts/trusted-leaf.crt"),
+        keyfile=here.path("../net/data/verificationcerts/trusted-leaf.key"),
+    )
+    return ctx
+
+
+@pytest.fixture(scope="module")
+def proxyserver() -> Proxyserver:
+    """
+    A Proxyserver instance shared by the playback tests. Replays never start its servers,
+    so it does not carry state from one test to the next. Options are still registered per addon context.
+    """
+    return Proxyserver()
+
+
+_EXPECTED_REQ = (
+    b"GET /path HTTP/1.1\r\n"
+    b"header: qvalue\r\n"
+    b"content-length: 4\r\nHost: example.mitmproxy.org\r\n\r\n"
+    b"data"
+)
+_EXPECTED_REQ_UPSTREAM = (
+    b"GET http://address:22/path HTTP/1.1\r\n"
+    b"header: qvalue\r\n"
+    b"content-length: 4\r\nHost: example.mitmproxy.org\r\n\r\n"
+    b"data"
+)
+
+
+@module_loop
+async def test_playback_all_modes(server_ssl_context, proxyserver, monkeypatch):
+    def make_handler(mode: str):
+        async def handler(
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            if mode == "err":
+                # Nothing was written, so there is nothing to flush: drop the connection right away.
+                writer.transport.abort()
+                return
+            expected = _EXPECTED_REQ_UPSTREAM if mode == "upstream" else _EXPECTED_REQ
+            assert await reader.readexactly(len(expected)) == expected
+            writer.write(b"HTTP/1.1 204 No Content\r\n\r\n")
+            if writer.can_write_eof():  # TLS transports do not support half-closing.
+                writer.write_eof()
+            await writer.drain()
+
+        return handler
+
+    # All modes are run in a single addon context, as setting it up is more expensive than the replay itself.
+    cp = ClientPlayback()
+    tls = TlsConfig()
+    with taddons.context(cp, proxyserver, tls) as tctx:
+        tctx.configure(
+            tls,
+            ssl_verify_upstream_trusted_ca=here.path(
+                "../net/data/verificationcerts/trusted-root.crt"
+            ),
         )
+        cp.running()
+
+        for concurrency, mode in itertools.product(
+            [-1, 1], ["http", "https", "upstream", "err"]
+        ):
+            server_args = {}
+            if mode == "https":
+                server_args["ssl"] = server_ssl_context
+
+            async with memory_server(make_handler(mode), **server_args) as srv:
+                monkeypatch.setattr(asyncio, "open_connection", srv.connect)
+                addr = srv.address
+                host_port = f"{addr[0]}:{addr[1]}"
+                if mode == "upstream":
+                    mode_spec = f"upstream:http://{host_port}"
+                else:
+                    mode_spec = "regular"
+                # A single update, so that addons are only notified once.
+                tctx.configure(
+                    cp, client_replay_concurrency=concurrency, mode=[mode_spec]
+                )
+                flow = tflow.tflow(live=False)
+                flow.request.content = b"data"
+                if mode == "upstream":
+                    flow.request.authority = host_port
+                    flow.request.host, flow.request.port = "address", 22
+                else:
+                    flow.request.host, flow.request.port = addr
+                if mode == "https":
+                    flow.request.scheme = "https"
+                # Used for SNI
+                flow.request.host_header = "example.mitmproxy.org"
+                cp.start_replay([flow])
+                assert cp.count() == 1
+                await join_replay_queue(cp)
+                await wait_for_replay_tasks(cp)
+            if mode != "err":
+                assert flow.response.status_code == 204, (mode, concurrency)
+            else:
+                assert flow.error, (mode, concurrency)
+        await cp.done()
+
+
+@module_loop
+async def test_playback_closes_cleanly(proxyserver, monkeypatch):
+    # test_playback_all_modes does not wait for this, so we check it only once here.
+    async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        assert await reader.readexactly(len(_EXPECTED_REQ)) == _EXPECTED_REQ
         writer.write(b"HTTP/1.1 204 No Content\r\n\r\n")
+        writer.write_eof()
         await writer.drain()
         assert not await reader.read()
 
     cp = ClientPlayback()
-    ps = Proxyserver()
-    tls = TlsConfig()
-    with taddons.context(cp, ps, tls) as tctx:
-        tctx.configure(cp, client_replay_concurrency=concurrency)
-
-        server_args = {}
-        if mode == "https":
-            server_args["ssl"] = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            server_args["ssl"].load_cert_chain(
-                certfile=tdata.path(
-                    "mitmproxy/net/data/verificationcerts/trusted-leaf.crt"
-                ),
-                keyfile=tdata.path(
-                    "mitmproxy/net/data/verificationcerts/trusted-leaf.key"
-                ),
-            )
-            tctx.configure(
-                tls,
-                ssl_verify_upstream_trusted_ca=tdata.path(
-                    "mitmproxy/net/data/verificationcerts/trusted-root.crt"
-                ),
-            )
-
-        async with tcp_server(handler, **server_args) as addr:
+    with taddons.context(cp, proxyserver):
+        async with memory_server(handler) as srv:
+            monkeypatch.setattr(asyncio, "open_connection", srv.connect)
             cp.running()
             flow = tflow.tflow(live=False)
             flow.request.content = b"data"
-            if mode == "upstream":
-                tctx.options.mode = [f"upstream:http://{addr[0]}:{addr[1]}"]
-                flow.request.authority = f"{addr[0]}:{addr[1]}"
-                flow.request.host, flow.request.port = "address", 22
-            else:
-                flow.request.host, flow.request.port = addr
-            if mode == "https":
-                flow.request.scheme = "https"
-            # Used for SNI
+            flow.request.host, flow.request.port = srv.address
             flow.request.host_header = "example.mitmproxy.org"
             cp.start_replay([flow])
-            assert cp.count() == 1
-            await asyncio.wait_for(cp.queue.join(), 5)
-            while cp.replay_tasks:
-                await asyncio.sleep(0.001)
-        if mode != "err":
-            assert flow.response.status_code == 204
+            await join_replay_queue(cp)
+        assert flow.response.status_code == 204
         await cp.done()
 
 
-async def test_playback_https_upstream():
+@module_loop
+async def test_playback_https_upstream(proxyserver, monkeypatch):
     async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         conn_req = await reader.readuntil(b"\r\n\r\n")
         assert conn_req == b"CONNECT address:22 HTTP/1.1\r\n\r\n"
         writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")
+        writer.write_eof()
         await writer.drain()
         assert not await reader.read()
 
     cp = ClientPlayback()
-    ps = Proxyserver()
-    with taddons.context(cp, ps) as tctx:
-        tctx.configure(cp)
-        async with tcp_server(handler) as addr:
+    with taddons.context(cp, proxyserver) as tctx:
+        async with memory_server(handler) as srv:
+            monkeypatch.setattr(asyncio, "open_connection", srv.connect)
+            host_port = f"{srv.address[0]}:{srv.address[1]}"
+            tctx.configure(cp, mode=[f"upstream:http://{host_port}"])
             cp.running()
             flow = tflow.tflow(live=False)
             flow.request.scheme = b"https"
             flow.request.content = b"data"
-            tctx.options.mode = [f"upstream:http://{addr[0]}:{addr[1]}"]
             cp.start_replay([flow])
             assert cp.count() == 1
-            await asyncio.wait_for(cp.queue.join(), 5)
+            await join_replay_queue(cp)
 
         assert flow.response is None
         assert (
             str(flow.error)
-            == f"Upstream proxy {addr[0]}:{addr[1]} refused HTTP CONNECT request: 502 Bad Gateway"
+            == f"Upstream proxy {host_port} refused HTTP CONNECT request: 502 Bad Gateway"
         )
         await cp.done()
 
 
+@module_loop
 async def test_playback_crash(monkeypatch, caplog_async):
     async def raise_err(*_, **__):
         raise ValueError("oops")
@@ -170,27 +392,35 @@ async def test_playback_crash(monkeypatch, caplog_async):
 
 def test_check():
     cp = ClientPlayback()
-    f = tflow.tflow(resp=True)
+    # check() only reads the flow, so shallow copies of a single flow are enough.
+    base = tflow.tflow(resp=True, live=False)
+    assert cp.check(base) is None
+
+    f = copy.copy(base)
     f.live = True
     assert "live flow" in cp.check(f)
 
-    f = tflow.tflow(resp=True, live=False)
+    f = copy.copy(base)
     f.intercepted = True
     assert "intercepted flow" in cp.check(f)
 
-    f = tflow.tflow(resp=True, live=False)
+    f = copy.copy(base)
     f.request = None
     assert "missing request" in cp.check(f)
 
-    f = tflow.tflow(resp=True, live=False)
+    f = copy.copy(base)
+    # A shallow copy of the request would still share its content with base.
+    f.request = base.request.copy()
     f.request.raw_content = None
     assert "missing content" in cp.check(f)
+    assert cp.check(base) is None
 
     for f in (tflow.ttcpflow(), tflow.tudpflow()):
         f.live = False
         assert "Can only replay HTTP" in cp.check(f)
 
 
+@module_loop
 async def test_start_stop(tdata, caplog_async):
     cp = ClientPlayback()
     with taddons.context(cp):
@@ -207,10 +437,10 @@ async def test_start_stop(tdata, caplog_async):
         assert cp.count() == 0
 
 
-def test_load(tdata):
+def test_load():
     cp = ClientPlayback()
     with taddons.context(cp):
-        cp.load_file(tdata.path("mitmproxy/data/dumpfile-018.mitm"))
+        cp.load_file(DUMPFILE)
         assert cp.count() == 1
 
         with pytest.raises(CommandError):
@@ -218,17 +448,14 @@ def test_load(tdata):
         assert cp.count() == 1
 
 
-def test_configure(tdata):
+def test_configure():
     cp = ClientPlayback()
     with taddons.context(cp) as tctx:
         assert cp.count() == 0
-        tctx.configure(
-            cp, client_replay=[tdata.path("mitmproxy/data/dumpfile-018.mitm")]
-        )
+        tctx.configure(cp, client_replay=[DUMPFILE])
         assert cp.count() == 1
-        tctx.configure(cp, client_replay=[])
+        tctx.configure(cp, client_replay=[], client_replay_concurrency=-1)
         with pytest.raises(OptionsError):
             tctx.configure(cp, client_replay=["nonexistent"])
-        tctx.configure(cp, client_replay_concurrency=-1)
         with pytest.raises(OptionsError):
             tctx.configure(cp, client_replay_concurrency=-2)